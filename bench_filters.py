@@ -0,0 +1,124 @@
+"""Microbenchmark: per-message cost of keyword filter matching with 1k+ rules.
+
+Compares, per rule set:
+- the old loop over chat_data["filters"] (`word.lower() in text`), which only
+  knows plain substrings
+- checking each rule on its own (substring, or its compiled regex), which is
+  what supporting word/wildcard/regex rules naively would cost
+- ChatMatcher.match(): plain and word rules in the Aho-Corasick automaton,
+  wildcard and regex rules behind one combined pattern
+
+ChatMatcher also runs the NSFW/promo patterns, so its numbers include work
+the other two skip. Build time (paid once per filter change) is shown too.
+
+Usage:
+   python bench_filters.py [filters] [iterations]
+"""
+
+import os
+import random
+import re
+import sys
+import time
+import timeit
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+
+from main import ChatMatcher, filter_rule_regex, normalize_message  # noqa: E402
+
+MESSAGES = [
+    "hello everyone, kal ka episode kab aayega?",
+    "bhai season 2 hindi dubbed chahiye",
+    "Kya koi bata sakta hai ki ye movie kis platform pe hai? Maine bahut search kiya par mila nahi.",
+    "ok",
+    "thanks bro",
+    "part 3 kab aayega yaar",
+    "नमस्ते सब लोग, आज का एपिसोड कब आएगा",
+    "lol 😂😂😂",
+]
+
+SYLLABLES = ["ka", "ri", "mo", "ta", "ne", "shi", "ro", "vi", "da", "lu", "po", "zen"]
+
+
+def make_rules(count: int, mixed: bool, seed: int = 1):
+    """`count` distinct rules; mixed sets are 70% plain, 15% w:, 10% wildcard, 5% re:."""
+    rng = random.Random(seed)
+    rules = {}
+    while len(rules) < count:
+        word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        roll = rng.random() if mixed else 0.0
+        if roll < 0.70:
+            rule = word
+        elif roll < 0.85:
+            rule = "w:" + word
+        elif roll < 0.95:
+            cut = rng.randrange(1, len(word))
+            rule = word[:cut] + "*" + word[cut + 1:]
+        else:
+            rule = f"re:{word[:3]}(?:{word[3:] or 'x'})?\\s?\\d+"
+        rules[rule] = "reply"
+    # one rule that actually fires, last so it cannot short-circuit the loops
+    rules["w:season 2" if mixed else "season 2"] = "Season 2 is not out yet."
+    return rules
+
+
+def legacy_match(rules: dict, text: str):
+    for word, reply in rules.items():
+        if word.lower() in text:
+            return word
+    return None
+
+
+def per_rule_matcher(rules: dict):
+    checks = []
+    for rule in rules:
+        source = filter_rule_regex(rule)
+        if source is None and rule.startswith("w:"):
+            source = rf"(?<!\w){re.escape(rule[2:])}(?!\w)"
+        checks.append((rule, re.compile(source).search if source else None))
+
+    def match(text: str):
+        for rule, search in checks:
+            if search(text) if search else rule in text:
+                return rule
+        return None
+
+    return match
+
+
+def per_message_us(func, texts, iterations: int) -> float:
+    def run():
+        for text, clean in texts:
+            func(text, clean)
+
+    best = min(timeit.repeat(run, number=iterations, repeat=3))
+    return best / (iterations * len(texts)) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    texts = [normalize_message(m) for m in MESSAGES]
+
+    print(f"{'rules':18} {'old loop':>10} {'per rule':>10} {'matcher':>10} {'build':>10}")
+    for name, mixed in (("plain", False), ("mixed", True)):
+        rules = make_rules(count, mixed)
+        started = time.perf_counter()
+        matcher = ChatMatcher(rules)
+        build_ms = (time.perf_counter() - started) * 1000
+        naive = per_rule_matcher(rules)
+
+        old = per_message_us(lambda text, clean: legacy_match(rules, text), texts, iterations) if not mixed else None
+        per_rule = per_message_us(lambda text, clean: naive(text), texts, iterations)
+        new = per_message_us(matcher.match, texts, iterations)
+        old_col = f"{old:7.1f} us" if old is not None else f"{'n/a':>10}"
+        print(f"{f'{name} ({len(rules)})':18} {old_col} {per_rule:7.1f} us {new:7.1f} us {build_ms:7.1f} ms")
+
+        for text, clean in texts:
+            expected = naive(text)
+            got = matcher.match(text, clean).filter_word
+            assert got == expected, (text, expected, got)
+
+
+if __name__ == "__main__":
+    main()
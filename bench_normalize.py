@@ -0,0 +1,90 @@
+"""Microbenchmark: per-message cost of building the `clean` text in on_message.
+
+Compares the old chain of ~20 str.replace calls with normalize_message()
+(a precomputed bytes.translate table, plus NFKC and confusable folding
+on non-ASCII input).
+
+Usage:
+   python bench_normalize.py [iterations]
+"""
+
+import sys
+import timeit
+
+from main import normalize_message
+
+SAMPLES = [
+    "hello everyone, kal ka episode kab aayega?",
+    "bhai season 2 hindi dubbed link de do",
+    "Join fast t.me/some_channel for free movies!!!",
+    "p.o.r.n l1nk in bio 🍆💦",
+    "DM me for premium content",
+    "ok",
+    "Ｆｒｅｅ ｎｕｄｅｓ ｃｌｉｃｋ ｎｏｗ",
+    "рогn vіdеоs hеrе",  # Cyrillic look-alikes
+    "s​e​x chat",  # zero-width joiners
+    "Kya koi bata sakta hai ki ye movie kis platform pe hai? Maine bahut search kiya par mila nahi.",
+    "नमस्ते सब लोग, आज का एपिसोड कब आएगा",
+    "lol 😂😂😂",
+]
+
+
+def legacy_clean(raw: str):
+    text = raw.lower()
+    clean = (
+        text.replace(" ", "")
+            .replace(".", "")
+            .replace("*", "")
+            .replace("_", "")
+            .replace("-", "")
+            .replace("•", "")
+            .replace("/", "")
+            .replace("\\", "")
+            .replace("|", "")
+            .replace("$", "s")
+            .replace("5", "s")
+            .replace("@", "a")
+            .replace("4", "a")
+            .replace("3", "e")
+            .replace("1", "i")
+            .replace("!", "i")
+            .replace("0", "o")
+            .replace("€", "e")
+            .replace("🍆", "dick")
+            .replace("🍑", "ass")
+            .replace("💦", "cum")
+    )
+    return text, clean
+
+
+def per_message_ns(func, samples, iterations: int) -> float:
+    def run():
+        for sample in samples:
+            func(sample)
+
+    best = min(timeit.repeat(run, number=iterations, repeat=5))
+    return best / (iterations * len(samples)) * 1e9
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+
+    groups = [
+        ("ascii", [s for s in SAMPLES if s.isascii()]),
+        ("non-ascii", [s for s in SAMPLES if not s.isascii()]),
+        ("all", SAMPLES),
+    ]
+    print(f"{'samples':12} {'replace chain':>15} {'normalize':>12}")
+    for name, samples in groups:
+        old = per_message_ns(legacy_clean, samples, iterations)
+        new = per_message_ns(normalize_message, samples, iterations)
+        print(f"{name + f' ({len(samples)})':12} {old:12.0f} ns {new:9.0f} ns  ({old / new:.2f}x)")
+
+    print()
+    print("sample                                   chain clean -> normalized clean")
+    for sample in SAMPLES:
+        print(f"{sample[:40]!r:42} {legacy_clean(sample)[1][:24]!r} -> {normalize_message(sample)[1][:24]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Offline replay benchmark: push update streams through the real handlers.
+
+Builds the application from main.build_application() with an in-process
+stand-in for the Bot API (no token, no network), feeds it a stream of
+updates and reports:
+
+- updates/sec and p50/p99 latency of Application.process_update
+- Bot API calls issued per update, per method
+- memory growth over the run (tracemalloc)
+
+The default stream is synthetic and mixes plain text, captions, bot
+"searching…" replies and answers, commands and NSFW/promo spam. A recorded
+stream (one raw Update JSON per line, as Telegram posts it to the webhook)
+can be replayed instead.
+
+Usage:
+   python bench_replay.py [updates] [--chats N] [--seed N] [--updates-file FILE] [--no-memory]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+# main.py writes its journal, archive and state DB to the working directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.TemporaryDirectory(prefix="bench_replay_")
+os.chdir(WORKDIR.name)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OWNER_ID", "1")
+# the replay runs far faster than real chats; keep flood control out of the way
+# unless it is what is being measured (set these explicitly to exercise it)
+os.environ.setdefault("RAID_CHAT_LIMIT", "1000000000")
+os.environ.setdefault("FLOOD_USER_LIMIT", "1000000000")
+os.environ.setdefault("DUP_THRESHOLD", "1000000000")  # the synthetic texts repeat verbatim
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Keepalive", "username": "keepalive_bot"}
+SEARCH_BOT = {"id": 777000, "is_bot": True, "first_name": "Search", "username": "search_bot"}
+ADMIN_USER = {"id": 1, "is_bot": False, "first_name": "Owner"}
+
+TEXTS = [
+    "hello everyone, kal ka episode kab aayega?",
+    "bhai season 2 hindi dubbed chahiye",
+    "Kya koi bata sakta hai ki ye movie kis platform pe hai?",
+    "ok",
+    "lol 😂😂😂",
+    "नमस्ते सब लोग, आज का एपिसोड कब आएगा",
+    "thanks bro",
+    "part 3 kab aayega yaar",
+]
+CAPTIONS = ["check this out", "poster of the new season", "screenshot"]
+SPAM = [
+    "Join fast t.me/some_channel for free movies!!!",
+    "p.o.r.n l1nk in bio 🍆💦",
+    "DM me for premium content",
+    "Ｆｒｅｅ ｎｕｄｅｓ ｃｌｉｃｋ ｎｏｗ",
+    "follow @promo_channel_xyz",
+]
+COMMANDS = ["/rank", "/top", "/filterlist", "/start", "/promostatus"]
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers Bot API calls locally and counts them per method."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_id = 10_000_000
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        result = self._answer(api_method, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def _answer(self, api_method, params):
+        if api_method == "getMe":
+            return dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=True,
+                        supports_inline_queries=False)
+        if api_method in ("sendMessage", "sendDocument"):
+            self._message_id += 1
+            return {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup", "title": "bench"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if api_method == "getChatAdministrators":
+            return [{"status": "creator", "user": ADMIN_USER, "is_anonymous": False}]
+        return True
+
+
+class SyntheticStream:
+    """Mixed update stream over a fixed set of chats and users."""
+
+    MIX = (
+        ("text", 55),
+        ("caption", 8),
+        ("spam", 12),
+        ("search", 10),
+        ("answer", 8),
+        ("command", 7),
+    )
+
+    def __init__(self, chats: int, users_per_chat: int, seed: int):
+        self.rng = random.Random(seed)
+        self.chats = [-1001000000000 - i for i in range(chats)]
+        self.users = users_per_chat
+        self.update_id = 0
+        self.message_ids = Counter()
+        self.recent = {chat_id: [] for chat_id in self.chats}  # user messages a bot can reply to
+        self.searching = {chat_id: [] for chat_id in self.chats}  # requests with a "searching" reply
+        kinds, weights = zip(*self.MIX)
+        self._kinds = kinds
+        self._weights = weights
+
+    def _message(self, chat_id, sender, **fields):
+        self.message_ids[chat_id] += 1
+        self.update_id += 1
+        message = {
+            "message_id": self.message_ids[chat_id],
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+            "from": sender,
+        }
+        message.update(fields)
+        return {"update_id": self.update_id, "message": message}
+
+    def _user(self, chat_id):
+        uid = abs(chat_id) % 1_000_000 * 1000 + self.rng.randrange(self.users) + 2
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+    def next(self):
+        rng = self.rng
+        chat_id = rng.choice(self.chats)
+        kind = rng.choices(self._kinds, self._weights)[0]
+
+        if kind == "search" and self.recent[chat_id]:
+            orig = self.recent[chat_id].pop(rng.randrange(len(self.recent[chat_id])))
+            self.searching[chat_id].append(orig)
+            return kind, self._message(chat_id, SEARCH_BOT, text="🔍 Searching…", reply_to_message=orig)
+        if kind == "answer" and self.searching[chat_id]:
+            orig = self.searching[chat_id].pop(0)
+            return kind, self._message(chat_id, SEARCH_BOT, text="Here you go: Episode 12", reply_to_message=orig)
+        if kind == "command":
+            command = rng.choice(COMMANDS)
+            entities = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+            return kind, self._message(chat_id, self._user(chat_id), text=command, entities=entities)
+        if kind == "spam":
+            return kind, self._message(chat_id, self._user(chat_id), text=rng.choice(SPAM))
+        if kind == "caption":
+            photo = [{"file_id": "AgAD", "file_unique_id": "AQAD", "width": 90, "height": 90}]
+            return "caption", self._message(chat_id, self._user(chat_id), caption=rng.choice(CAPTIONS), photo=photo)
+
+        update = self._message(chat_id, self._user(chat_id), text=rng.choice(TEXTS))
+        self.recent[chat_id].append(update["message"])
+        del self.recent[chat_id][:-20]
+        return "text", update
+
+
+def recorded_stream(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield "recorded", json.loads(line)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+async def replay(args):
+    api = FakeBotAPI()
+    persistence = main.SQLitePersistence(os.path.join(os.getcwd(), "bench_state.sqlite3"))
+    application = main.build_application(request=api, persistence=persistence)
+    await application.initialize()
+    await application.post_init(application)
+
+    if args.updates_file:
+        stream = recorded_stream(args.updates_file)
+        total = None
+    else:
+        synthetic = SyntheticStream(args.chats, args.users, args.seed)
+        stream = iter(synthetic.next, None)
+        total = args.updates
+
+    # seed a filter per chat so the keyword path is exercised too
+    if not args.updates_file:
+        for chat_id in synthetic.chats:
+            application.chat_data[chat_id]["filters"] = {"season 2": "Season 2 is not out yet."}
+
+    bot = application.bot
+    warmup = min(args.warmup, total or args.warmup)
+    latencies = []
+    kinds = Counter()
+    api_before = 0
+    started = 0.0
+
+    if args.memory:
+        tracemalloc.start()
+    mem_start = 0
+    count = 0
+    for kind, data in stream:
+        if count == warmup:
+            api_before = sum(api.calls.values())
+            api.calls.clear()
+            mem_start = tracemalloc.get_traced_memory()[0] if args.memory else 0
+            started = time.perf_counter()
+        update = Update.de_json(data, bot)
+        t0 = time.perf_counter()
+        await application.process_update(update)
+        elapsed = time.perf_counter() - t0
+        await asyncio.sleep(0)  # let background work (outbox, scheduler) run, as a live loop would
+        count += 1
+        if count > warmup:
+            latencies.append(elapsed)
+            kinds[kind] += 1
+        if total is not None and count >= total + warmup:
+            break
+    wall = time.perf_counter() - started
+    queued = len(main.OUTBOX)
+    if args.memory:
+        mem_end, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    await application.post_stop(application)  # checkpoints the armed search timeouts
+    await application.shutdown()
+
+    measured = len(latencies)
+    if not measured:
+        raise SystemExit(f"only {count} updates, all used for warm-up; lower --warmup")
+    latencies.sort()
+    api_total = sum(api.calls.values())
+    print(f"updates     {measured} (after {warmup} warm-up, {api_before} API calls during warm-up)")
+    print("mix         " + ", ".join(f"{k} {v}" for k, v in kinds.most_common()))
+    print(f"throughput  {measured / wall:,.0f} updates/sec")
+    print(f"latency     mean {sum(latencies) / measured * 1e6:,.0f} us   "
+          f"p50 {percentile(latencies, 0.50) * 1e6:,.0f} us   "
+          f"p99 {percentile(latencies, 0.99) * 1e6:,.0f} us   max {latencies[-1] * 1e6:,.0f} us")
+    print(f"api calls   {api_total / measured:.3f} per update "
+          f"({queued} outbound jobs still queued by rate limits, "
+          f"{main.OUTBOX.coalesced} warnings coalesced)")
+    for api_method, calls in api.calls.most_common():
+        print(f"   {api_method:24} {calls:8} {calls / measured:.3f}/update")
+    if args.memory:
+        print(f"memory      +{(mem_end - mem_start) / 1024:,.0f} KiB over the run "
+              f"({(mem_end - mem_start) / measured:,.0f} B/update), peak {mem_peak / 1024:,.0f} KiB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("updates", nargs="?", type=int, default=20_000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=200, help="users per chat")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1_000)
+    parser.add_argument("--updates-file", help="replay recorded updates (one JSON object per line)")
+    parser.add_argument(
+        "--no-memory", dest="memory", action="store_false",
+        help="skip tracemalloc, which slows every allocation and inflates the timings",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(replay(parse_args()))
+    finally:
+        WORKDIR.cleanup()
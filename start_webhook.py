@@ -1,26 +1,46 @@
 """Run the existing bot (main.py) using Telegram Webhooks instead of polling.
 
 Why this file exists:
-- Your current main.py builds the whole bot + handlers and finally calls application.run_polling().
+- main.py polls Telegram by default.
 - On Render free tier, polling tends to waste outbound traffic + can lead to instability.
-- This runner monkey-patches python-telegram-bot's run_polling() to run_webhook() *without touching your existing bot logic*.
+- This runner starts the same bot in webhook mode. main.py serves the webhook path,
+  /health and /metrics from one HTTP server on PORT, inside the bot's own event loop.
 
 How to use on Render:
 1) Add these Environment Variables in Render:
    - WEBHOOK_URL   = https://<your-service>.onrender.com
    - WEBHOOK_PATH  = <any-random-secret-path>  (example: hook_9f3a2c1e...)
+   - WEBHOOK_SECRET = <random string>  (optional, checked on every webhook request)
    - BOT_TOKEN, OWNER_ID, DELETE_DELAY etc (already used by main.py)
 
 2) Change your Start Command / Procfile to run:
    python start_webhook.py
 
+Sharded mode (SHARDS=N, N > 1):
+- One Python process is limited by the GIL. With SHARDS set, this process becomes
+  a router: it owns PORT and the webhook, starts N bot workers on SHARD_PORT..SHARD_PORT+N-1
+  (localhost) and forwards each update to worker chat_id % N, so every chat is
+  handled by exactly one process.
+- Workers share STATE_DB; each keeps its own deletion journal, search checkpoint
+  and log archive (<file>.shardI). On startup the router redistributes the journals
+  of the previous run, so N can change between restarts.
+- /health is 200 only while every worker is ready; /metrics merges the workers'
+  metrics with a shard label. A worker that exits is restarted, after a delay that
+  doubles with each exit in a row (up to SHARD_RESTART_MAX_DELAY); a worker that keeps
+  crashing is logged as an error and shows in router_shard_consecutive_exits.
+
 Notes:
-- This disables the extra HTTP keepalive server in main.py because webhook needs the same PORT.
-- If you still want a /health endpoint for UptimeRobot, we can implement a small ASGI/Flask wrapper later.
+- UptimeRobot can keep pinging https://<your-service>.onrender.com/health as before.
 """
 
+import asyncio
+import json
 import os
+import re
+import signal
+import subprocess
 import sys
+import time
 
 # ---- Required env vars ----
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")   # e.g. https://your-app.onrender.com
@@ -34,39 +54,321 @@ if not WEBHOOK_URL or not WEBHOOK_PATH:
         "  WEBHOOK_PATH=hook_<random>\n"
     )
 
-WEBHOOK_FULL_URL = f"{WEBHOOK_URL}/{WEBHOOK_PATH}"
+# ---- Sharding ----
+SHARDS = int(os.getenv("SHARDS", "1"))  # bot worker processes behind the webhook
+SHARD_PORT = int(os.getenv("SHARD_PORT", str(int(os.getenv("PORT", "10000")) + 1)))  # first worker port
+SHARD_READY_TIMEOUT = float(os.getenv("SHARD_READY_TIMEOUT", "120"))  # seconds for workers to come up
+SHARD_RESTART_MAX_DELAY = float(os.getenv("SHARD_RESTART_MAX_DELAY", "60"))  # cap on the restart backoff, seconds
+SHARD_STABLE_SECONDS = float(os.getenv("SHARD_STABLE_SECONDS", "60"))  # uptime that resets the backoff
+SHARD_CRASH_ALERT = int(os.getenv("SHARD_CRASH_ALERT", "5"))  # exits in a row logged as a crash loop
 
-# Import telegram types AFTER env checks (helps fail fast in logs)
-from telegram.ext import Application  # python-telegram-bot
+# Import the bot AFTER env checks (helps fail fast in logs)
+import main as bot_main  # noqa: E402
+from tornado.httpclient import AsyncHTTPClient  # noqa: E402
+from tornado.httpserver import HTTPServer  # noqa: E402
+from tornado.web import Application as WebApplication, RequestHandler  # noqa: E402
 
-# Monkey-patch run_polling -> run_webhook
-_original_run_polling = Application.run_polling
+from telegram import Bot, Update  # noqa: E402
 
-def _run_webhook_instead(self: Application, *args, **kwargs):
-    # Render provides PORT in env; main.py already reads it, but we also read it here.
-    port = int(os.getenv("PORT", "10000"))
-    return self.run_webhook(
-        listen="0.0.0.0",
-        port=port,
-        url_path=WEBHOOK_PATH,
-        webhook_url=WEBHOOK_FULL_URL,
-        drop_pending_updates=True,  # optional: prevents backlog on redeploy
-    )
+logger = bot_main.logger
 
-Application.run_polling = _run_webhook_instead  # type: ignore[attr-defined]
+ROUTER_METRICS = bot_main.MetricsRegistry()
+FORWARDED = ROUTER_METRICS.counter(
+    "router_updates_forwarded_total", "Webhook updates forwarded to a shard.", ("shard", "status")
+)
+FORWARD_SECONDS = ROUTER_METRICS.histogram(
+    "router_forward_seconds", "Time for a shard to accept a forwarded update.", ("shard",)
+)
 
-# Now import your existing bot code (keeps all features/handlers)
-import main as bot_main  # noqa: E402
 
-# Disable the separate keepalive HTTP server in main.py to avoid PORT conflict
-if hasattr(bot_main, "run_http_server"):
-    bot_main.run_http_server = lambda: None  # type: ignore[assignment]
+def update_chat_id(data: dict):
+    """The chat an update belongs to, read from the raw webhook JSON."""
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+        sender = value.get("from") or value.get("user")  # inline queries, polls: keep a user on one shard
+        if sender:
+            return sender.get("id")
+    return None
+
+
+class ShardRouter:
+    """Starts the shard workers, forwards updates to them and restarts any that exit.
+
+    A worker that exits is restarted after 1s, doubling for each exit in a
+    row up to SHARD_RESTART_MAX_DELAY; staying up SHARD_STABLE_SECONDS
+    clears the count.
+    """
+
+    def __init__(self, shards: int, first_port: int):
+        self.shards = shards
+        self.ports = [first_port + i for i in range(shards)]
+        self.procs = [None] * shards
+        self.restarts = [0] * shards
+        self.exits = [0] * shards  # exits in a row, without SHARD_STABLE_SECONDS of uptime between
+        self._started_at = [0.0] * shards
+        self._restart_at = [None] * shards  # monotonic time of a pending restart
+        self.client = AsyncHTTPClient(max_clients=256)
+        self.stopping = False
+        self._supervisor = None
+
+    def _spawn(self, index: int):
+        env = dict(
+            os.environ,
+            SHARD_INDEX=str(index),
+            PORT=str(self.ports[index]),
+            SCHEDULE_JOURNAL=bot_main.shard_path(bot_main.SCHEDULE_JOURNAL, index, self.shards),
+            SEARCH_CHECKPOINT=bot_main.shard_path(bot_main.SEARCH_CHECKPOINT, index, self.shards),
+            ARCHIVE_FILE=bot_main.shard_path(bot_main.ARCHIVE_FILE, index, self.shards),
+            # Telegram's ~30 msg/s bot limit is shared by all workers
+            GLOBAL_SEND_RATE=str(bot_main.GLOBAL_SEND_RATE / self.shards),
+        )
+        self.procs[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self._started_at[index] = time.monotonic()
+
+    def start(self):
+        bot_main.reshard_state(self.shards)
+        for index in range(self.shards):
+            self._spawn(index)
+        self._supervisor = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for index, proc in enumerate(self.procs):
+                if self.stopping:
+                    break
+                now = time.monotonic()
+                if self._restart_at[index] is not None:
+                    if now >= self._restart_at[index]:
+                        self._restart_at[index] = None
+                        self.restarts[index] += 1
+                        self._spawn(index)
+                    continue
+                if now - self._started_at[index] >= SHARD_STABLE_SECONDS:
+                    self.exits[index] = 0
+                if proc.poll() is None:
+                    continue
+                self.exits[index] += 1
+                delay = min(SHARD_RESTART_MAX_DELAY, 2.0 ** (self.exits[index] - 1))
+                self._restart_at[index] = now + delay
+                if self.exits[index] >= SHARD_CRASH_ALERT:
+                    logger.error(
+                        f"Shard {index} is crash-looping: exited with {proc.returncode}, "
+                        f"{self.exits[index]} times in a row; restarting in {delay:g}s"
+                    )
+                else:
+                    logger.warning(f"Shard {index} exited with {proc.returncode}; restarting in {delay:g}s")
+
+    def shard_for(self, data: dict) -> int:
+        chat_id = update_chat_id(data)
+        return 0 if chat_id is None else bot_main.shard_of(chat_id, self.shards)
+
+    async def fetch(self, index: int, path: str, **kwargs):
+        return await self.client.fetch(f"http://127.0.0.1:{self.ports[index]}{path}", raise_error=False, **kwargs)
+
+    async def forward(self, index: int, body: bytes, headers: dict) -> int:
+        started = time.perf_counter()
+        try:
+            # the worker answers once it has room, which also holds Telegram back
+            response = await self.fetch(
+                index, "/" + WEBHOOK_PATH, method="POST", body=body, headers=headers, request_timeout=60
+            )
+            status = response.code if response.code != 599 else 502
+        except Exception:
+            status = 502
+        FORWARDED.labels(str(index), str(status)).inc()
+        FORWARD_SECONDS.labels(str(index)).observe(time.perf_counter() - started)
+        return status
+
+    async def health(self):
+        responses = await asyncio.gather(
+            *(self.fetch(i, "/health", request_timeout=2) for i in range(self.shards)),
+            return_exceptions=True,
+        )
+        return [r.code if not isinstance(r, Exception) else 599 for r in responses]
+
+    async def wait_ready(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if all(code == 200 for code in await self.health()):
+                return True
+            await asyncio.sleep(0.5)
+        return False
+
+    async def metrics(self) -> str:
+        responses = await asyncio.gather(
+            *(self.fetch(i, "/metrics", request_timeout=5) for i in range(self.shards)),
+            return_exceptions=True,
+        )
+        texts = [
+            r.body.decode() if not isinstance(r, Exception) and r.code == 200 else ""
+            for r in responses
+        ]
+        return merge_metrics(texts) + ROUTER_METRICS.render()
+
+    async def stop(self, timeout: float):
+        """SIGTERM every worker and wait for their own graceful shutdown."""
+        self.stopping = True
+        if self._supervisor:
+            self._supervisor.cancel()
+        for proc in self.procs:
+            if proc and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while any(proc.poll() is None for proc in self.procs) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        for index, proc in enumerate(self.procs):
+            if proc.poll() is None:
+                logger.warning(f"Shard {index} did not stop in time; killing it")
+                proc.kill()
+        self.client.close()
+
+
+SAMPLE_RE = re.compile(r"([^{\s]+)(?:\{(.*)\})?( .*)")
+
+
+def merge_metrics(texts) -> str:
+    """Merge the workers' /metrics output, adding a shard label to every sample.
+
+    The text format wants each family's samples together under one
+    HELP/TYPE header, so samples are regrouped by family.
+    """
+    families = {}  # name -> [header lines, sample lines]; insertion ordered
+    for index, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split(" ", 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = [[], []]
+                if line not in family[0]:
+                    family[0].append(line)
+                continue
+            match = SAMPLE_RE.fullmatch(line)
+            if family is None or not match:
+                continue
+            name, labels, value = match.groups()
+            labels = f'shard="{index}",{labels}' if labels else f'shard="{index}"'
+            family[1].append(f"{name}{{{labels}}}{value}")
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+class RouterWebhookHandler(RequestHandler):
+    def initialize(self, router):
+        self.router = router
+
+    async def post(self):
+        secret = bot_main.WEBHOOK_SECRET
+        headers = {"Content-Type": "application/json"}
+        if secret:
+            if self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                self.set_status(403)
+                return
+            headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            logger.warning("Dropping malformed webhook payload")
+            self.set_status(400)
+            return
+        # a non-200 answer makes Telegram deliver the update again later
+        self.set_status(await self.router.forward(self.router.shard_for(data), self.request.body, headers))
+
+
+class RouterHealthHandler(RequestHandler):
+    def initialize(self, router):
+        self.router = router
+
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        codes = await self.router.health()
+        ready = bot_main.LIFECYCLE.ready and all(code == 200 for code in codes)
+        self.set_status(200 if ready else 503)
+        self.write("".join(f"shard {i}: {'ok' if code == 200 else code}\n" for i, code in enumerate(codes)))
+
+    async def head(self):
+        codes = await self.router.health()
+        self.set_status(200 if bot_main.LIFECYCLE.ready and all(code == 200 for code in codes) else 503)
+
+
+class RouterMetricsHandler(RequestHandler):
+    def initialize(self, router):
+        self.router = router
+
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(await self.router.metrics())
+
+
+async def route(shards: int):
+    """Front process: own the webhook and PORT, fan updates out to the shard workers."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: rely on KeyboardInterrupt
+
+    router = ShardRouter(shards, SHARD_PORT)
+    ROUTER_METRICS.counter_fn(
+        "router_shard_restarts_total", "Shard workers restarted after exiting.",
+        lambda: {(str(i),): n for i, n in enumerate(router.restarts)}, ("shard",),
+    )
+    ROUTER_METRICS.gauge_fn(
+        "router_shard_consecutive_exits", "Shard worker exits in a row; high values mean a crash loop.",
+        lambda: {(str(i),): n for i, n in enumerate(router.exits)}, ("shard",),
+    )
+    router.start()
+
+    kwargs = {"router": router}
+    server = HTTPServer(WebApplication(
+        [
+            (r"/", RouterHealthHandler, kwargs),
+            (r"/health", RouterHealthHandler, kwargs),
+            (r"/metrics", RouterMetricsHandler, kwargs),
+            ("/" + re.escape(WEBHOOK_PATH), RouterWebhookHandler, kwargs),
+        ],
+        log_function=lambda handler: None,
+    ))
+    server.listen(bot_main.PORT)
+    logger.info(f"Shard router on port {bot_main.PORT}, {shards} workers from port {SHARD_PORT}")
 
-if __name__ == "__main__":
     try:
-        # Call your existing entrypoint; it will internally call application.run_polling(),
-        # but due to the monkey-patch, it will actually start webhook mode.
-        bot_main.main()
+        if not await router.wait_ready(SHARD_READY_TIMEOUT):
+            logger.warning("Not every shard is ready; registering the webhook anyway")
+        async with Bot(bot_main.BOT_TOKEN) as bot:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False,  # undelivered updates wait for the restarted shards
+                secret_token=bot_main.WEBHOOK_SECRET or None,
+            )
+        logger.info(f"Ready in {bot_main.LIFECYCLE.mark_ready():.2f}s")
+        await stop.wait()
     finally:
-        # Restore original method in case anything else imports this module
-        Application.run_polling = _original_run_polling  # type: ignore[attr-defined]
+        bot_main.LIFECYCLE.mark_stopping()
+        server.stop()  # Telegram retries whatever it cannot deliver now
+        await router.stop(bot_main.SHUTDOWN_DEADLINE + 5)
+        logger.info(f"Shutdown complete in {time.monotonic() - bot_main.LIFECYCLE.stopping_since:.2f}s")
+
+
+if __name__ == "__main__":
+    if bot_main.SHARD_INDEX >= 0:
+        bot_main.main(webhook_path=WEBHOOK_PATH)  # worker started by the router
+    elif SHARDS > 1:
+        try:
+            asyncio.run(route(SHARDS))
+        except KeyboardInterrupt:
+            pass
+    else:
+        bot_main.main(webhook_url=WEBHOOK_URL, webhook_path=WEBHOOK_PATH)